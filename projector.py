@@ -1,4 +1,9 @@
 from abc import abstractmethod
+from enum import Enum
+from select import select
+from struct import Struct
+from time import monotonic, sleep
+from types import MappingProxyType
 import serial
 
 
@@ -79,6 +84,8 @@ class Button(object):
         ASPECT: b"\x37\x37",
     }
 
+    VALID_NAMES = frozenset(CODES)
+
 
 class InputSource(object):
     S_VIDEO = "s-video"
@@ -103,24 +110,138 @@ class InputSource(object):
 
 
 class ProjectorCommunicationError(Exception):
-    pass
+    # the message is only formatted when something asks for it, as callers
+    # often just catch these and carry on
+    def __init__(self, msg="", *args_raw):
+        super().__init__(msg, *args_raw)
+        self.msg = msg
+        self.args_raw = args_raw
+
+    def __str__(self):
+        if not self.args_raw:
+            return self.msg
+        return self.msg % self.args_raw
+
+    # args and repr show the formatted message, as they did before
+    @property
+    def args(self):
+        return (str(self),) if self.msg else ()
+
+    def __repr__(self):
+        return "%s(%s)" % (type(self).__name__, ", ".join(map(repr, self.args)))
+
+
+class Cmd(Enum):
+    # values are the command bytes as sent on the wire
+    READY = b"\x00\x00"
+    POWER = b"\x50\x57"
+    INPUT = b"\x49\x50"
+    MODEL = b"\x4d\x44"
+    RC = b"\x52\x43"
+    RC73 = b"\x52\x43\x37\x33"
+
+
+# result code and unit id at the start of every response
+_RESPONSE_HEADER = Struct(">BH")
+
+
+def _wire(cmd):
+    # raw bytes are passed through so commands without a Cmd still work
+    return cmd.value if isinstance(cmd, Cmd) else cmd
 
 
 class Projector(object):
+    # how long (in seconds) queried state is reused before asking the device again
+    CACHE_TTL = 0.5
+
+    # subclasses for a known model report this instead of querying the device
+    MODEL_NAME = None
+
+    # input name -> code, provided by each model
+    INPUT_SOURCES = {}
+
+    # longest single wait (in seconds) while polling the port for a response
+    POLL_INTERVAL = 0.05
 
     def __init__(self, port_url, unit_id=b"\x89\x01", timeout=1):
         self.url = port_url
+        # the port itself never blocks, recv polls it up to self.timeout
         self.port = serial.serial_for_url(
-            port_url, 19200, parity="N", stopbits=1, timeout=timeout
+            port_url, 19200, parity="N", stopbits=1, timeout=0
         )
+        self.timeout = timeout
+        self._rx = bytearray()
 
         self.unit_id = unit_id
+        self._unit_id_int = int.from_bytes(unit_id, "big")
+        self._cache = {}
+
+        # all the fixed commands we send, already in wire format
+        self._prebuilt = {}
+        for header, cmd, data in [
+            (b"\x21", Cmd.READY, None),  # ready
+            (b"\x21", Cmd.POWER, b"\x31"),  # turn on
+            (b"\x21", Cmd.POWER, b"\x30"),  # turn off
+            (b"\x21", Cmd.MODEL, None),  # model
+            (b"\x3f", Cmd.POWER, None),  # mode
+            (b"\x3f", Cmd.INPUT, None),  # input
+        ]:
+            self._prebuilt[(header, cmd, data)] = self._build_packet(header, cmd, data)
+        for code in Button.CODES.values():
+            key = (b"\x21", Cmd.RC73, code)
+            self._prebuilt[key] = self._build_packet(*key)
+        for code in self.INPUT_SOURCES.values():
+            key = (b"\x21", Cmd.INPUT, code)
+            self._prebuilt[key] = self._build_packet(*key)
+
+        # how ack (0x06) and data (0x40) responses start for each command
+        self._prefixes = {}
+        for cmd in Cmd:
+            self._response_prefixes(cmd)
+
+    def _build_packet(self, header, cmd, data=None):
+        return header + self.unit_id + _wire(cmd) + (data or b"") + b"\x0A"
+
+    def _response_prefixes(self, cmd):
+        prefixes = self._prefixes.get(cmd)
+        if prefixes is None:
+            tail = self.unit_id + _wire(cmd)
+            prefixes = (b"\x06" + tail, b"\x40" + tail)
+            self._prefixes[cmd] = prefixes
+        return prefixes
+
+    def _packet(self, header, cmd, data=None):
+        pkt = self._prebuilt.get((header, cmd, data))
+        if pkt is None:
+            pkt = self._build_packet(header, cmd, data)
+        return pkt
+
+    def _cached(self, key, ttl, fn):
+        now = monotonic()
+        if key in self._cache:
+            expires, value = self._cache[key]
+            if now < expires:
+                return value
+
+        value = fn()
+        self._store(key, value, ttl, now)
+        return value
+
+    def _store(self, key, value, ttl=None, now=None):
+        if ttl is None:
+            ttl = self.CACHE_TTL
+        if now is None:
+            now = monotonic()
+        self._cache[key] = (now + ttl, value)
+
+    def invalidate_cache(self):
+        self._cache.clear()
 
     def send_operating(self, cmd, data=None, response_cmd=None):
-        return self.send(b"\x21", cmd, data, response_cmd)
+        return self._exchange(b"\x21", cmd, data, response_cmd)
 
     def send_reference(self, cmd, data=None):
-        was_ok = self.send(b"\x3f", cmd, data)
+        was_ok = self._exchange(b"\x3f", cmd, data)
 
         # we don't get any data back
         if was_ok == True:
@@ -128,78 +249,173 @@ class Projector(object):
         else:
             return (was_ok, None)
 
-    def send(self, header, cmd, data=None, response_cmd=None):
-        footer = b"\x0A"
-        if data:
-            pkt = [header, self.unit_id, cmd, data, footer]
-        else:
-            pkt = [header, self.unit_id, cmd, footer]
-
-        self.port.write(b"".join(pkt))
+    def _exchange(self, header, cmd, data=None, response_cmd=None):
+        # anything still waiting belongs to an earlier exchange
+        self._resync()
+        self.port.write(self._packet(header, cmd, data))
 
         # check for the command we sent back out, unless another was specified
-        if not response_cmd:
+        if response_cmd is None:
             response_cmd = cmd
 
         return self.recv(response_cmd)
 
+    send = _exchange
+
+    def send_batch(self, cmds):
+        # write several (header, cmd[, data]) commands in one go, then read
+        # back every response, so the line turnaround is only paid once
+        self._write_batch(cmds)
+
+        results = []
+        for entry in cmds:
+            try:
+                result = self._recv_result(entry[0], entry[1])
+            except ProjectorCommunicationError:
+                # recv dropped whatever else was received, so the remaining
+                # responses are lost too
+                if not any(result is not None for result in results):
+                    raise
+                results.extend([None] * (len(cmds) - len(results)))
+                break
+            results.append(result)
+
+        return results
+
+    def _write_batch(self, cmds):
+        self._resync()
+        self.port.write(b"".join(self._packet(*entry) for entry in cmds))
+
+    def _recv_result(self, header, cmd):
+        result = self.recv(cmd)
+        # reference commands follow their ack with a data response
+        if header == b"\x3f":
+            if result == True:
+                result = self.recv(cmd)
+            else:
+                result = None
+        return result
+
+    def _wait_readable(self, timeout):
+        # select() gives up the GIL while we wait; ports without a file
+        # descriptor (e.g. on Windows or non-local URLs) just sleep instead
+        fd = getattr(self.port, "fd", None)
+        if fd is not None:
+            select([fd], [], [], timeout)
+        else:
+            sleep(timeout)
+
+    def _resync(self):
+        # drop everything received so far, so the next read starts on a
+        # fresh response instead of the tail of a broken one
+        del self._rx[:]
+        self.port.reset_input_buffer()
+
+    def _read_frame(self):
+        # returns everything up to and including the next \n, or whatever
+        # arrived in time if the device is too slow
+        buf = self._rx
+        deadline = monotonic() + self.timeout
+        while True:
+            end = buf.find(b"\x0A") + 1
+            if end:
+                break
+
+            remaining = deadline - monotonic()
+            if remaining <= 0:
+                frame = bytes(buf)
+                self._resync()
+                return frame
+
+            waiting = self.port.in_waiting
+            if waiting:
+                # take everything buffered, it may hold the next responses too
+                buf += self.port.read(waiting)
+            else:
+                self._wait_readable(min(remaining, self.POLL_INTERVAL))
+
+        frame = bytes(buf[:end])
+        del buf[:end]
+        return frame
+
     def recv(self, cmd):
         # 0x40 = response
         # 0x06 = ACK
-        resp = self.port.readline()
+        # both are result code + unit id + cmd [+ data] + \n; frames are
+        # always cut at the \n, so one bad response can't shift the next
+        try:
+            return self._parse(self._read_frame(), cmd)
+        except ProjectorCommunicationError:
+            self._resync()
+            raise
+
+    def _parse(self, resp, cmd):
+        # a well-formed response is just one of the two known prefixes
+        ack, data = self._response_prefixes(cmd)
+        if resp.endswith(b"\x0A"):
+            if resp.startswith(ack):
+                return True
+            if resp.startswith(data):
+                return resp[len(data) : -1]  # don't include trailing \n
+
+        # otherwise work out what was wrong with it
+        cmd = _wire(cmd)
         if not resp:
             raise ProjectorCommunicationError("no response from projector")
 
-        result_code = resp[0]
-        if result_code == 0x06:
-            msgtype = "ack"
-        elif result_code == 0x040:
-            msgtype = "data"
-        else:
+        if len(resp) < 4 + len(cmd) or not resp.endswith(b"\x0A"):
+            raise ProjectorCommunicationError(
+                "incomplete response from projector %r", resp
+            )
+
+        # read the header fields as integers and compare the command in
+        # place, rather than slicing out a new bytes object for each
+        result_code, response_unit_id = _RESPONSE_HEADER.unpack_from(resp)
+        if result_code not in (0x06, 0x40):
             raise ProjectorCommunicationError(
-                "device returned unknown result code %r" % result_code
+                "device returned unknown result code %r", result_code
             )
 
         # ensure the unit ID matched
-        response_unit_id = resp[1:3]
-        if response_unit_id != self.unit_id:
+        if response_unit_id != self._unit_id_int:
             raise ProjectorCommunicationError(
-                "device returned unknown unit id %r" % response_unit_id
+                "device returned unknown unit id %#06x", response_unit_id
             )
 
-        response_cmd = resp[3 : 3 + len(cmd)]
+        response_cmd = memoryview(resp)[3 : 3 + len(cmd)]
         if response_cmd != cmd:
             raise ProjectorCommunicationError(
-                "device returned response command response %r for command %r"
-                % (response_cmd, cmd)
+                "device returned response command response %r for command %r",
+                bytes(response_cmd),
+                cmd,
             )
 
-        data = resp[3 + len(cmd) : -1]  # don't include trailing \n
-
-        if msgtype == "data":
-            return data
-        elif msgtype == "ack":
-            return True
-        elif msgtype == "fail":
-            return False
-        else:
-            raise ValueError("invalid internal msgtype")
+        raise ProjectorCommunicationError("unexpected response %r", resp)
 
     @property
     def ready(self):
-        return self.send_operating(b"\x00\x00")
+        return self.send_operating(Cmd.READY)
 
     @property
     def mode(self):
+        return self._cached("mode", self.CACHE_TTL, self._query_mode)
+
+    def _query_mode(self):
         success = None
         try:
-            success, state = self.send_reference(b"\x50\x57")
+            success, state = self.send_reference(Cmd.POWER)
+        except ProjectorCommunicationError:
+            # the projector being unreachable is reported as no mode
+            pass
         except Exception as ex:
             print(ex)
 
         if not success:
             return None
 
+        return self._parse_mode(state)
+
+    def _parse_mode(self, state):
         # note these are strings
         modes = {
             b"\x30": "standby",
@@ -214,22 +430,26 @@ class Projector(object):
         raise ValueError("unknown power state " + repr(state))
 
     def turn_on(self):
-        return self.send_operating(b"\x50\x57", b"\x31")
+        self.invalidate_cache()
+        return self.send_operating(Cmd.POWER, b"\x31")
 
     def turn_off(self):
-        return self.send_operating(b"\x50\x57", b"\x30")
+        self.invalidate_cache()
+        return self.send_operating(Cmd.POWER, b"\x30")
 
     def set_input(self, source):
-        # this command is only valid when powered on
-        if self.mode != "power-on":
-            return False
-
         try:
             code = self.source_to_code(source)
         except KeyError:
             return ValueError("invalid input " + repr(source))
 
-        return self.send_operating(b"\x49\x50", code)
+        # this command is only valid when powered on; rather than asking for
+        # the power state first, let the device turn it down
+        self.invalidate_cache()
+        try:
+            return self.send_operating(Cmd.INPUT, code)
+        except ProjectorCommunicationError:
+            return False
 
     def press_button(self, btn):
         if btn not in self.valid_buttons:
@@ -239,20 +459,30 @@ class Projector(object):
         # if self.mode == 'standby':
         #     return None
 
+        # buttons such as on/standby/input change the state we report
+        self.invalidate_cache()
         return self.send_operating(
-            b"\x52\x43\x37\x33", Button.CODES[btn], response_cmd=b"\x52\x43"
+            Cmd.RC73, Button.CODES[btn], response_cmd=Cmd.RC
         )
 
     @property
     def input(self):
-        # this command is only valid when powered on
-        if self.mode != "power-on":
+        return self._cached("input", self.CACHE_TTL, self._query_input)
+
+    def _query_input(self):
+        # this command is only valid when powered on, which the device will
+        # tell us itself
+        try:
+            success, state = self.send_reference(Cmd.INPUT)
+        except ProjectorCommunicationError:
             return None
 
-        success, state = self.send_reference(b"\x49\x50")
         if not success:
             return None
 
+        return self._parse_input(state)
+
+    def _parse_input(self, state):
         # note these are strings
         try:
             source = self.code_to_source(state)
@@ -263,7 +493,52 @@ class Projector(object):
 
     @property
     def model(self):
-        return self.send_operating(b"\x4d\x44")
+        return self._cached("model", self.CACHE_TTL, self._query_model)
+
+    def _query_model(self):
+        if self.MODEL_NAME:
+            return self.MODEL_NAME
+
+        return self.send_operating(Cmd.MODEL)
+
+    def status(self):
+        # the input query is written along with the others, but only waited
+        # for when the projector is on; otherwise whatever the device says
+        # back is left to the _resync() at the start of the next exchange
+        cmds = [(b"\x3f", Cmd.POWER)]
+        if not self.MODEL_NAME:
+            cmds.append((b"\x21", Cmd.MODEL))
+        cmds.append((b"\x3f", Cmd.INPUT))
+        self._write_batch(cmds)
+
+        state = self._recv_result(b"\x3f", Cmd.POWER)
+        mode = self._parse_mode(state) if state else None
+
+        model = self.MODEL_NAME
+        in_step = True
+        if not model:
+            try:
+                model = self._recv_result(b"\x21", Cmd.MODEL)
+            except ProjectorCommunicationError:
+                # recv dropped the input response along with this one
+                model = None
+                in_step = False
+
+        source = None
+        if mode == "power-on" and in_step:
+            try:
+                state = self._recv_result(b"\x3f", Cmd.INPUT)
+            except ProjectorCommunicationError:
+                state = None
+            if state:
+                source = self._parse_input(state)
+
+        # keep the cache in step with what we just read
+        self._store("mode", mode)
+        self._store("input", source)
+        self._store("model", model)
+
+        return {"mode": mode, "input": source, "model": model}
 
     @abstractmethod
     def source_to_code(self, source):
@@ -285,7 +560,9 @@ class Projector(object):
 
 
 class HD250(Projector):
-    VALID_BUTTONS = set([
+    MODEL_NAME = "DLA-HD250"
+
+    VALID_BUTTONS = frozenset((
         Button.UP,
         Button.DOWN,
         Button.BACK,
@@ -318,7 +595,7 @@ class HD250(Projector):
         Button.GAMMA,
         Button.COLOR_TEMP,
         Button.ASPECT,
-    ])
+    ))
 
     INPUT_SOURCES = {
         InputSource.S_VIDEO: b"\x30",
@@ -330,14 +607,13 @@ class HD250(Projector):
 
     SOURCE_CODES = {code: name for name, code in INPUT_SOURCES.items()}
 
-    VALID_SOURCES = {name for name in INPUT_SOURCES.keys()}
+    VALID_SOURCES_DISPLAY = MappingProxyType(
+        {src: InputSource.name(src) for src in INPUT_SOURCES}
+    )
 
     @property
     def valid_sources(self):
-        result = {}
-        for src in self.VALID_SOURCES:
-            result[src] = InputSource.name(src)
-        return result
+        return self.VALID_SOURCES_DISPLAY
 
     @property
     def valid_buttons(self):
@@ -349,13 +625,11 @@ class HD250(Projector):
     def code_to_source(self, code):
         return self.SOURCE_CODES[code]
 
-    @property
-    def model(self):
-        return "DLA-HD250"
-
 
 class RS40(Projector):
-    VALID_BUTTONS = set([
+    MODEL_NAME = "DLA-RS40"
+
+    VALID_BUTTONS = frozenset((
         Button.UP,
         Button.DOWN,
         Button.BACK,
@@ -380,7 +654,7 @@ class RS40(Projector):
         Button.GAMMA,
         Button.COLOR_TEMP,
         Button.ASPECT,
-    ])
+    ))
 
     INPUT_SOURCES = {
         InputSource.COMPONENT: b"\x32",
@@ -389,14 +663,13 @@ class RS40(Projector):
     }
     SOURCE_CODES = {code: name for name, code in INPUT_SOURCES.items()}
 
-    VALID_SOURCES = {name for name in INPUT_SOURCES.keys()}
+    VALID_SOURCES_DISPLAY = MappingProxyType(
+        {src: InputSource.name(src) for src in INPUT_SOURCES}
+    )
 
     @property
     def valid_sources(self):
-        result = {}
-        for src in self.VALID_SOURCES:
-            result[src] = InputSource.name(src)
-        return result
+        return self.VALID_SOURCES_DISPLAY
 
     @property
     def valid_buttons(self):
@@ -408,10 +681,6 @@ class RS40(Projector):
     def code_to_source(self, code):
         return self.SOURCE_CODES[code]
 
-    @property
-    def model(self):
-        return "DLA-RS40"
-
 
 if __name__ == "__main__":
     p = HD250("/dev/ttyUSB0")
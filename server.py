@@ -1,15 +1,58 @@
 import json
+import os
 
+from copy import copy
 from functools import wraps
+from queue import Empty, Queue
+from socketserver import ThreadingMixIn
+from threading import Event, Lock, Thread
+from time import monotonic
 from traceback import format_tb
 from sys import exc_info
-from wsgiref.simple_server import make_server
+from wsgiref.simple_server import WSGIServer, make_server
 from wsgiref.util import shift_path_info
 
+try:
+    # C implementation that hands back bytes, when it's available
+    from orjson import dumps as json_dumps
+except ImportError:
+
+    def json_dumps(obj):
+        return json.dumps(obj).encode("utf8")
+
+
 from projector import Button, InputSource, RS40, ProjectorCommunicationError
 
 projector = None
 
+# the serial port can only carry one conversation at a time, so every command
+# is handed to a single worker thread through this queue
+projector_queue = Queue()
+# how long (in seconds) a request waits for the worker before giving up
+COMMAND_TIMEOUT = 10
+# the worker thread, started by the first command
+worker = None
+worker_lock = Lock()
+
+# queries currently being answered, so later callers can wait for the result
+inflight = {}
+inflight_lock = Lock()
+
+# static responses; the JSON ones are built on first use, once the projector
+# is known
+BUTTONS_JSON = None
+INPUTS_JSON = None
+
+INDEX_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "index.html")
+with open(INDEX_PATH, "rb") as f:
+    INDEX_HTML = f.read()
+
+
+class ThreadingWSGIServer(ThreadingMixIn, WSGIServer):
+    # handle each request in its own thread so a slow projector doesn't hold
+    # up requests that never touch it
+    daemon_threads = True
+
 
 class WebException(Exception):
     def __init__(self, code, msg=None):
@@ -37,11 +80,49 @@ class WebException(Exception):
         return "<h1>%s</h1><p>%s</p>" % (self.code, self.msg)
 
 
+def projector_worker():
+    while True:
+        f, args, reply, deadline = projector_queue.get()
+        # whoever asked has already given up, don't replay it now
+        if monotonic() >= deadline:
+            continue
+
+        try:
+            reply.put((True, f(*args)))
+        except Exception as ex:
+            reply.put((False, ex))
+
+
+def start_worker():
+    global worker
+    with worker_lock:
+        if worker is None:
+            worker = Thread(target=projector_worker, daemon=True)
+            worker.start()
+
+
+def run_on_projector(f, args):
+    if worker is None:
+        start_worker()
+
+    reply = Queue(maxsize=1)
+    deadline = monotonic() + COMMAND_TIMEOUT
+    projector_queue.put((f, args, reply, deadline))
+    try:
+        ok, value = reply.get(timeout=COMMAND_TIMEOUT)
+    except Empty:
+        raise ProjectorCommunicationError("timed out waiting for projector")
+
+    if not ok:
+        raise value
+    return value
+
+
 def projector_command(f):
     @wraps(f)
-    def decorated(*args, **kwargs):
+    def decorated(*args):
         try:
-            return f(*args, **kwargs)
+            return run_on_projector(f, args)
         except ProjectorCommunicationError:
             raise WebException(
                 "503 Service Unavailable",
@@ -53,78 +134,151 @@ def projector_command(f):
     return decorated
 
 
+class Flight(object):
+    def __init__(self):
+        self.done = Event()
+        self.outcome = None
+
+
+def single_flight(key, f, args):
+    with inflight_lock:
+        flight = inflight.get(key)
+        leader = flight is None
+        if leader:
+            flight = inflight[key] = Flight()
+
+    if leader:
+        try:
+            result = f(*args)
+            flight.outcome = (True, result)
+            return result
+        except Exception as ex:
+            flight.outcome = (False, ex)
+            raise
+        finally:
+            with inflight_lock:
+                del inflight[key]
+            flight.done.set()
+
+    flight.done.wait()
+    ok, value = flight.outcome
+    if not ok:
+        # each waiter raises its own copy, so their tracebacks don't mix
+        raise copy(value)
+    return value
+
+
+def projector_query(f):
+    # read-only commands can be answered once for everyone waiting on them
+    command = projector_command(f)
+
+    @wraps(f)
+    def decorated(*args):
+        return single_flight((f, args), command, args)
+
+    return decorated
+
+
 # information only (this may change if we
 # implement an auto-instanciated projector class)
 def view_buttons():
-    return json.dumps({"names": projector.valid_buttons})
+    global BUTTONS_JSON
+    if BUTTONS_JSON is None:
+        BUTTONS_JSON = json_dumps({"names": sorted(projector.valid_buttons)})
+    return BUTTONS_JSON
 
 
 def view_inputs():
-    sources = {k: v for k, v in sorted(projector.valid_sources.items(), key=lambda x: x[1])}
-    return json.dumps(sources)
+    global INPUTS_JSON
+    if INPUTS_JSON is None:
+        sources = sorted(projector.valid_sources.items(), key=lambda x: x[1])
+        INPUTS_JSON = json_dumps(dict(sources))
+    return INPUTS_JSON
 
 
 @projector_command
+def press_button(button):
+    return json_dumps({"success": projector.press_button(button)})
+
+
 def press(button):
+    # checked here so a bad request doesn't wait behind queued commands
     button = button.lower()
-    if button not in Button.CODES:
+    if button not in Button.VALID_NAMES:
         raise WebException("404 Not Found", "No such button " + button)
 
-    return json.dumps({"success": projector.press_button(button)})
+    return press_button(button)
 
 
-@projector_command
+@projector_query
 def projector_status():
-    return json.dumps(
-        {"mode": projector.mode, "input": projector.input, "model": projector.model}
-    )
+    return json_dumps(projector.status())
 
 
 @projector_command
+def change_input(source):
+    return json_dumps({"success": projector.set_input(source)})
+
+
 def set_input(source):
     # source = source.lower()
     if source not in projector.valid_sources:
         raise WebException("404 Not Found", "Invalid source " + source)
 
-    return json.dumps({"success": projector.set_input(source)})
+    return change_input(source)
 
 
 @projector_command
 def on():
-    return json.dumps({"success": projector.turn_on()})
+    return json_dumps({"success": projector.turn_on()})
 
 
 @projector_command
 def off():
-    return json.dumps({"success": projector.turn_off()})
+    return json_dumps({"success": projector.turn_off()})
 
 
 def index():
-    return open("index.html", "rt").read()
+    return INDEX_HTML
 
 
-def remote_webapp(environ, start_response):
-    routes = {
-        "buttons": view_buttons,
-        "inputs": view_inputs,
-        "press": lambda: press(shift_path_info(environ)),
-        "status": projector_status,
-        "input": lambda: set_input(shift_path_info(environ)),
-        "on": on,
-        "off": off,
-        "": index,
-    }
+def _press_route(environ):
+    return press(shift_path_info(environ))
+
+
+def _input_route(environ):
+    return set_input(shift_path_info(environ))
+
 
+ROUTES = {
+    "buttons": view_buttons,
+    "inputs": view_inputs,
+    "press": _press_route,
+    "status": projector_status,
+    "input": _input_route,
+    "on": on,
+    "off": off,
+    "": index,
+}
+
+# routes that take the rest of the path from the WSGI environment
+_ENV_ROUTES = frozenset([_press_route, _input_route])
+
+
+def remote_webapp(environ, start_response):
     result = None
     base_path = shift_path_info(environ)
-    if base_path not in routes:
+    if base_path not in ROUTES:
         status = "404 Not Found"
         headers = [("Content-type", "text/html")]
         result = str(WebException(status))
     else:
         try:
-            handler = routes[base_path]
-            result = handler()
+            handler = ROUTES[base_path]
+            if handler in _ENV_ROUTES:
+                result = handler(environ)
+            else:
+                result = handler()
             status = "200 OK"  # HTTP Status
             if handler == index:
                 headers = [("Content-type", "text/html")]
@@ -147,7 +301,8 @@ def remote_webapp(environ, start_response):
 
     start_response(status, headers)
 
-    result = result.encode("utf8")
+    if isinstance(result, str):
+        result = result.encode("utf8")
     return [result]
 
 
@@ -158,7 +313,10 @@ if __name__ == "__main__":
         sys.stderr.write("Usage: %s [serial device]\n" % sys.argv[0])
     else:
         projector = RS40(sys.argv[1], timeout=0.4)
-        httpd = make_server("", 8000, remote_webapp)
+        start_worker()
+        httpd = make_server(
+            "", 8000, remote_webapp, server_class=ThreadingWSGIServer
+        )
         print("Serving on port 8000...")
 
         # Serve until process is killed